@@ -11,11 +11,20 @@ Environment variables:
   GCP_BILLING_PROJECT_ID  - GCP project containing the billing export
   GCP_BILLING_DATASET_ID  - BigQuery dataset name
   GCP_BILLING_TABLE_ID    - BigQuery table name (e.g., gcp_billing_export_resource_v1_XXXXXX)
+
+Fetched rows are cached in costs/.cache/gcp/rows.jsonl. Later runs only
+re-query the last few days (late-arriving credits) and reuse cached rows
+for the rest of the window; a rerun of the same query on the same day is
+served from the cache without contacting BigQuery.
 """
 
+import hashlib
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
+from itertools import chain
+from pathlib import Path
 
+import orjson
 from google.cloud import bigquery
 
 
@@ -23,92 +32,239 @@ PROJECT_ID = os.environ.get("GCP_BILLING_PROJECT_ID")
 DATASET_ID = os.environ.get("GCP_BILLING_DATASET_ID")
 TABLE_ID = os.environ.get("GCP_BILLING_TABLE_ID")
 
+CACHE_FILE = Path("costs/.cache/gcp/rows.jsonl")
+
+# Days before the latest cached date that are always re-queried, since
+# billing data for recent days keeps changing as credits arrive.
+REFETCH_DAYS = 3
+
 
 def get_client():
     """Create a BigQuery client."""
     return bigquery.Client(project=PROJECT_ID)
 
 
-def fetch_daily_costs(days=45):
+def base_cte():
     """
-    Query BigQuery for daily costs per resource, service, and project.
+    WITH clause selecting billing line items used on or after the @start_date
+    query parameter.
 
-    Returns list of dicts with keys:
-      usage_date, project_id, project_name, service_name,
-      resource_name, net_cost, currency
+    The net cost (cost plus credits) is computed once per line item here so
+    the queries built on top only need a single SUM. The _PARTITIONTIME
+    filter lets BigQuery prune older partitions; it starts a day early so
+    rows whose partition date falls before their UTC usage date are still
+    read. The usage date filter is the exact one.
     """
-    client = get_client()
     table_ref = f"`{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`"
 
-    query = f"""
+    return f"""
+    WITH base AS (
+        SELECT
+            DATE(usage_start_time) AS usage_date,
+            project.id AS project_id,
+            project.name AS project_name,
+            service.description AS service_name,
+            resource.name AS resource_name,
+            cost + IFNULL(
+                (SELECT SUM(c.amount) FROM UNNEST(credits) c), 0
+            ) AS cost_net,
+            currency
+        FROM {table_ref}
+        WHERE _PARTITIONTIME >= TIMESTAMP(DATE_SUB(@start_date, INTERVAL 1 DAY))
+          AND DATE(usage_start_time) >= @start_date
+    )"""
+
+
+def costs_and_totals_query():
+    """Query for per-resource daily costs and daily totals from @start_date onwards."""
+    return base_cte() + """
     SELECT
-        DATE(usage_start_time) AS usage_date,
-        project.id AS project_id,
-        project.name AS project_name,
-        service.description AS service_name,
-        resource.name AS resource_name,
-        ROUND(SUM(cost) + SUM(IFNULL(
-            (SELECT SUM(c.amount) FROM UNNEST(credits) c), 0
-        )), 4) AS net_cost,
-        currency
-    FROM {table_ref}
-    WHERE DATE(usage_start_time) >= DATE_SUB(CURRENT_DATE(), INTERVAL {days} DAY)
-    GROUP BY usage_date, project_id, project_name, service_name,
-             resource_name, currency
+        usage_date,
+        project_id,
+        project_name,
+        service_name,
+        resource_name,
+        ROUND(SUM(cost_net), 4) AS net_cost,
+        currency,
+        GROUPING(resource_name) = 1 AS is_total
+    FROM base
+    GROUP BY GROUPING SETS (
+        (usage_date),
+        (usage_date, project_id, project_name, service_name, resource_name, currency)
+    )
     HAVING net_cost != 0
-    ORDER BY usage_date DESC, net_cost DESC
+    ORDER BY is_total DESC, usage_date DESC, net_cost DESC
     """
 
-    print(f"Querying BigQuery for last {days} days of costs...")
-    result = client.query(query).result()
 
-    rows = []
-    for row in result:
-        rows.append({
-            "usage_date": row.usage_date.strftime("%Y-%m-%d") if row.usage_date else None,
-            "project_id": row.project_id,
-            "project_name": row.project_name,
-            "service_name": row.service_name,
-            "resource_name": row.resource_name or "_unknown_",
-            "net_cost": float(row.net_cost),
-            "currency": row.currency,
-        })
+def fetch_daily_costs_and_totals(days=45):
+    """
+    Query BigQuery for daily costs per resource, service, and project, along
+    with accurate daily totals (no grouping by resource).
 
-    print(f"  Got {len(rows)} cost entries")
-    return rows
+    Both groupings come from a single scan of the billing table using
+    GROUPING SETS. When the cache covers the window, only dates from
+    REFETCH_DAYS before its latest date onwards are queried; older dates are
+    read from the cache. If the cache was written today by the same query,
+    BigQuery is skipped entirely. Returns (totals, rows):
+      totals - dict of date -> total cost
+      rows   - iterator of tuples:
+                 (usage_date, project_id, project_name, service_name,
+                  resource_name, net_cost, currency)
+               streamed from the result pages, ordered by usage_date descending
+    The cache is rewritten once rows has been fully consumed.
+    """
+    table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
 
+    today = datetime.now(timezone.utc).date()
+    start = (today - timedelta(days=days)).isoformat()
+    query = costs_and_totals_query()
+    sql_hash = hashlib.sha256(query.encode()).hexdigest()
 
-def fetch_daily_totals(days=45):
-    """
-    Query BigQuery for accurate daily totals (no grouping by resource).
+    since = start
+    cache = read_cache_meta(table_ref, sql_hash, start)
+    if cache and cache["end"]:
+        refetch_from = date.fromisoformat(cache["end"]) - timedelta(days=REFETCH_DAYS)
+        since = max(start, refetch_from.isoformat())
 
-    Returns dict of date -> total cost.
-    """
-    client = get_client()
-    table_ref = f"`{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`"
+    # A cache written today by the same query over the same window is reused as is
+    query_hash = hashlib.sha256(f"{query}\n{start}".encode()).hexdigest()
+    if cache and cache.get("query_hash") == query_hash and cache.get("fetched_on") == today.isoformat():
+        print(f"Using costs since {start} cached earlier today")
+        return cache["totals"], read_cached_rows(start)
 
-    query = f"""
-    SELECT
-        DATE(usage_start_time) AS usage_date,
-        ROUND(SUM(cost) + SUM(IFNULL(
-            (SELECT SUM(c.amount) FROM UNNEST(credits) c), 0
-        )), 4) AS net_cost
-    FROM {table_ref}
-    WHERE DATE(usage_start_time) >= DATE_SUB(CURRENT_DATE(), INTERVAL {days} DAY)
-    GROUP BY usage_date
-    HAVING net_cost != 0
-    ORDER BY usage_date DESC
-    """
+    # The query text is fixed and the start date is passed as a parameter, so
+    # BigQuery's results cache can answer repeat runs without scanning the table again
+    client = get_client()
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("start_date", "DATE", date.fromisoformat(since))],
+        use_query_cache=True,
+        labels={"app": "gcp-costs"},
+    )
 
-    result = client.query(query).result()
+    print(f"Querying BigQuery for costs since {since}...")
+    result = iter(client.query(query, job_config=job_config).result())
 
+    # Totals rows sort first; stop at the first per-resource row
     totals = {}
+    first = None
     for row in result:
+        if not row.is_total:
+            first = row
+            break
         date_str = row.usage_date.strftime("%Y-%m-%d") if row.usage_date else None
         if date_str:
             totals[date_str] = float(row.net_cost)
 
-    return totals
+    rows = cost_row_tuples(chain([first], result) if first else ())
+
+    if since > start:
+        print(f"  Using cached costs from {start} to before {since}")
+        for date_str, cost in cache["totals"].items():
+            if start <= date_str < since:
+                totals[date_str] = cost
+        rows = chain(rows, read_cached_rows(start, since))
+
+    meta = {
+        "table": table_ref,
+        "start": start,
+        "end": max(totals, default=None),
+        "fetched_on": today.isoformat(),
+        "sql_hash": sql_hash,
+        "query_hash": query_hash,
+        "totals": totals,
+    }
+    return totals, write_cache(meta, rows)
+
+
+def cost_row_tuples(rows):
+    """Convert per-resource BigQuery rows to plain tuples as they are read."""
+    count = 0
+    for row in rows:
+        count += 1
+        yield (
+            row.usage_date.strftime("%Y-%m-%d") if row.usage_date else None,
+            row.project_id,
+            row.project_name,
+            row.service_name,
+            row.resource_name or "_unknown_",
+            float(row.net_cost),
+            row.currency,
+        )
+
+    print(f"  Got {count} cost entries")
+
+
+def read_cache_meta(table_ref, sql_hash, start):
+    """
+    Read the cache header line.
+
+    Returns None if there is no usable cache, i.e. it is missing, unreadable,
+    for another table, written by a different query, or does not reach back
+    to start.
+    """
+    try:
+        with open(CACHE_FILE, "rb") as f:
+            meta = orjson.loads(f.readline())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    if meta.get("table") != table_ref or meta.get("sql_hash") != sql_hash or meta.get("start", start) > start:
+        return None
+    return meta
+
+
+def read_cached_rows(start, end=None):
+    """Yield cached row tuples with start <= usage_date < end (if given), newest first."""
+    with open(CACHE_FILE, "rb") as f:
+        f.readline()
+        for line in f:
+            row = orjson.loads(line)
+            if row[0] < start:
+                break
+            if end is None or row[0] < end:
+                yield tuple(row)
+
+
+def write_cache(meta, rows):
+    """Pass rows through, writing them to a new cache that replaces the old one once rows is exhausted."""
+    CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = CACHE_FILE.with_suffix(".tmp")
+    with open(tmp_file, "wb") as f:
+        f.write(orjson.dumps(meta, option=orjson.OPT_APPEND_NEWLINE))
+        for row in rows:
+            f.write(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE))
+            yield row
+    os.replace(tmp_file, CACHE_FILE)
+
+
+def fetch_date_range(days=45):
+    """
+    Query BigQuery for the usage date range of the last `days` days without
+    fetching any cost rows.
+
+    Returns (first_date, last_date, day_count); dates are None if there is no data.
+    """
+    client = get_client()
+    start = datetime.now(timezone.utc).date() - timedelta(days=days)
+
+    query = base_cte() + """
+    SELECT
+        MIN(usage_date) AS first_date,
+        MAX(usage_date) AS last_date,
+        COUNT(DISTINCT usage_date) AS day_count
+    FROM base
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("start_date", "DATE", start)],
+        labels={"app": "gcp-costs"},
+    )
+
+    row = next(iter(client.query(query, job_config=job_config).result()))
+    return (
+        row.first_date.strftime("%Y-%m-%d") if row.first_date else None,
+        row.last_date.strftime("%Y-%m-%d") if row.last_date else None,
+        row.day_count,
+    )
 
 
 def validate_config():
@@ -123,8 +279,8 @@ def validate_config():
 
 if __name__ == "__main__":
     validate_config()
-    rows = fetch_daily_costs()
-    print(f"Fetched {len(rows)} rows")
-    if rows:
-        dates = sorted(set(r["usage_date"] for r in rows if r["usage_date"]))
-        print(f"Date range: {dates[0]} to {dates[-1]}")
+    first_date, last_date, day_count = fetch_date_range()
+    if first_date:
+        print(f"Date range: {first_date} to {last_date} ({day_count} days)")
+    else:
+        print("No cost data found")
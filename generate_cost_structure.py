@@ -5,115 +5,173 @@ Generate GCP cost directory structure from BigQuery billing export data.
 Structure:
   costs/gcp/
   ├── by-resource/{resource_name}/cost.json
-  ├── by-project/{project_id}/{resource_name} -> symlink
-  ├── by-service/{service_name}/{resource_name} -> symlink
+  ├── by-project/index.json   {project_id: [resource_name, ...]}
+  ├── by-service/index.json   {service_name: [resource_name, ...]}
   └── summary.json
 """
 
 import os
 import sys
-import json
+import heapq
 import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
 
+import orjson
+
 sys.path.insert(0, str(Path(__file__).parent))
-from fetch_gcp_costs import fetch_daily_costs, fetch_daily_totals, validate_config
+from fetch_gcp_costs import fetch_daily_costs_and_totals, validate_config
 
 COSTS_DIR = Path("costs/gcp")
 
+# The new structure is built here and swapped into COSTS_DIR once complete,
+# so readers never see a partially written tree
+STAGING_DIR = Path("costs/gcp.tmp")
+
+# Threads writing per-resource cost.json files
+WRITE_WORKERS = 16
+
+SANITIZE_TABLE = str.maketrans({"/": "_", "\\": "_", ":": "_", " ": "_"})
+
+
+@dataclass(slots=True)
+class ResourceCosts:
+    """Cost aggregates for one resource in the output structure."""
 
+    resource_name: str
+    project_id: str
+    project_name: str
+    category_costs: defaultdict = field(default_factory=lambda: defaultdict(float))
+    daily_costs: list = field(default_factory=list)  # [date ordinal, cost] pairs, newest first
+    total_cost: float = 0
+    rolling_30d_cost: float = 0
+
+
+def write_file(path, data):
+    """Write bytes to path."""
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@lru_cache(maxsize=4096)
 def sanitize_name(name):
     """Sanitize name for filesystem use."""
     if not name:
         return "_unknown_"
-    return name.replace("/", "_").replace("\\", "_").replace(":", "_").replace(" ", "_")
+    return name.translate(SANITIZE_TABLE)
 
 
 def generate_structure(rows, accurate_totals=None):
-    """Generate the directory structure with daily costs and rolling 30-day aggregates."""
+    """
+    Generate the directory structure with daily costs and rolling 30-day aggregates.
+
+    rows is consumed in a single pass and must be ordered by usage_date
+    descending, as returned by fetch_daily_costs_and_totals. Returns the
+    summary, or None if rows is empty (the existing structure is left
+    untouched).
+    """
     today = datetime.now().strftime("%Y-%m-%d")
 
-    # Clean and recreate
-    if COSTS_DIR.exists():
-        shutil.rmtree(COSTS_DIR)
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return None
 
-    by_resource = COSTS_DIR / "by-resource"
-    by_project = COSTS_DIR / "by-project"
-    by_service = COSTS_DIR / "by-service"
+    # Clear any staging tree left behind by an interrupted run
+    if STAGING_DIR.exists():
+        shutil.rmtree(STAGING_DIR)
+
+    by_resource = STAGING_DIR / "by-resource"
+    by_project = STAGING_DIR / "by-project"
+    by_service = STAGING_DIR / "by-service"
 
     by_resource.mkdir(parents=True)
     by_project.mkdir(parents=True)
     by_service.mkdir(parents=True)
 
-    # Determine currency from data (GCP billing is typically in one currency per billing account)
-    currencies = set(r.get("currency", "USD") for r in rows)
-    currency = currencies.pop() if len(currencies) == 1 else "USD"
-
-    # Get date range
-    all_dates = sorted(set(r["usage_date"] for r in rows if r.get("usage_date")))
+    # Rows arrive newest first, so the first row carries the latest date
+    all_dates = [first[0]] if first[0] else []
     if accurate_totals:
-        all_dates = sorted(set(all_dates) | set(accurate_totals.keys()))
-    data_start = all_dates[0] if all_dates else today
-    data_end = all_dates[-1] if all_dates else today
+        all_dates.extend(accurate_totals.keys())
+    data_end = max(all_dates) if all_dates else today
+    data_start = min(all_dates) if all_dates else today
 
     # Rolling 30-day cutoff from end of data
     data_end_dt = datetime.strptime(data_end, "%Y-%m-%d")
     cutoff_date = (data_end_dt - timedelta(days=30)).strftime("%Y-%m-%d")
+    cutoff_ord = data_end_dt.toordinal() - 30
 
-    # Aggregate by project + resource (so same-named resources in different projects stay separate)
+    # Aggregate by project + resource (so same-named resources in different projects stay separate).
+    # Rows are grouped on their raw (project_id, resource_name) columns, so the key is
+    # only sanitized once per group rather than once per row.
+    # Each date is parsed once into an ordinal (date_ord), used as its id in the
+    # per-resource daily cost pairs and for integer compares against the cutoff.
     resources = {}
-    for row in rows:
-        resource_name = row.get("resource_name") or "_unknown_"
-        project_id = row.get("project_id") or "_unknown_project_"
-        # Key by project + resource to avoid merging across projects
-        key = f"{sanitize_name(project_id)}_{sanitize_name(resource_name)}" if resource_name == "_unknown_" else sanitize_name(resource_name)
-        date = row.get("usage_date")
-        cost = row.get("net_cost", 0)
-        service = row.get("service_name")
-
-        if key not in resources:
-            resources[key] = {
-                "resource_name": resource_name if resource_name != "_unknown_" else f"_unknown_ ({project_id})",
-                "project_id": project_id,
-                "project_name": row.get("project_name"),
-                "categories": set(),
-                "category_costs": {},
-                "daily_costs": {},
-                "total_cost": 0,
-                "rolling_30d_cost": 0,
-            }
+    groups = {}
+    date_ord = {}
+    date_names = {}
+    currencies = set()
+    daily_totals = defaultdict(float)
+    for date, project_id, project_name, service, resource_name, cost, row_currency in chain([first], rows):
+        currencies.add(row_currency)
+
+        res = groups.get((project_id, resource_name))
+        if res is None:
+            group = (project_id, resource_name)
+            resource_name = resource_name or "_unknown_"
+            project_id = project_id or "_unknown_project_"
+            # Key by project + resource to avoid merging across projects
+            key = f"{sanitize_name(project_id)}_{sanitize_name(resource_name)}" if resource_name == "_unknown_" else sanitize_name(resource_name)
+            res = resources.get(key)
+            if res is None:
+                res = resources[key] = ResourceCosts(
+                    resource_name=resource_name if resource_name != "_unknown_" else f"_unknown_ ({project_id})",
+                    project_id=project_id,
+                    project_name=project_name,
+                )
+            groups[group] = res
 
+        if date:
+            date_id = date_ord.get(date)
+            if date_id is None:
+                date_id = date_ord[date] = datetime.strptime(date, "%Y-%m-%d").toordinal()
+                date_names[date_id] = date
+                if date < data_start:
+                    data_start = date
+            # Rows arrive newest first, so a resource's costs for the same day are
+            # adjacent and its pairs come out already sorted
+            daily = res.daily_costs
+            if daily and daily[-1][0] == date_id:
+                daily[-1][1] += cost
+            else:
+                daily.append([date_id, cost])
+            daily_totals[date] += cost
+
+        in_window = date and date_id >= cutoff_ord
         if service:
-            resources[key]["categories"].add(service)
-            if service not in resources[key]["category_costs"]:
-                resources[key]["category_costs"][service] = 0
-            if date and date >= cutoff_date:
-                resources[key]["category_costs"][service] += cost
+            # Services seen only before the cutoff still get a (zero) entry, so the
+            # keys double as the resource's categories
+            res.category_costs[service] += cost if in_window else 0.0
 
-        if date:
-            if date not in resources[key]["daily_costs"]:
-                resources[key]["daily_costs"][date] = 0
-            resources[key]["daily_costs"][date] += cost
+        res.total_cost += cost
+        if in_window:
+            res.rolling_30d_cost += cost
 
-        resources[key]["total_cost"] += cost
-        if date and date >= cutoff_date:
-            resources[key]["rolling_30d_cost"] += cost
+    # Determine currency from data (GCP billing is typically in one currency per billing account)
+    currency = currencies.pop() if len(currencies) == 1 else "USD"
 
     # Calculate unallocated costs
     if accurate_totals:
-        detailed_by_day = {}
-        for res_data in resources.values():
-            for date, cost in res_data["daily_costs"].items():
-                if date not in detailed_by_day:
-                    detailed_by_day[date] = 0
-                detailed_by_day[date] += cost
-
         unallocated_daily = {}
         total_unallocated = 0
         rolling_unallocated = 0
         for date, accurate_cost in accurate_totals.items():
-            detailed_cost = detailed_by_day.get(date, 0)
+            detailed_cost = daily_totals.get(date, 0)
             diff = accurate_cost - detailed_cost
             if abs(diff) > 0.01:
                 unallocated_daily[date] = round(diff, 2)
@@ -122,85 +180,93 @@ def generate_structure(rows, accurate_totals=None):
                     rolling_unallocated += diff
 
         if unallocated_daily:
-            resources["_unallocated_"] = {
-                "resource_name": "_unallocated_",
-                "project_id": None,
-                "project_name": None,
-                "categories": {"Unallocated"},
-                "daily_costs": unallocated_daily,
-                "total_cost": total_unallocated,
-                "rolling_30d_cost": rolling_unallocated,
-            }
-
-    # Write per-resource files and create symlinks
+            unallocated_costs = []
+            for date, cost in sorted(unallocated_daily.items(), reverse=True):
+                daily_totals[date] += cost
+                date_id = date_ord.get(date)
+                if date_id is None:
+                    date_id = date_ord[date] = datetime.strptime(date, "%Y-%m-%d").toordinal()
+                    date_names[date_id] = date
+                unallocated_costs.append([date_id, cost])
+            resources["_unallocated_"] = ResourceCosts(
+                resource_name="_unallocated_",
+                project_id=None,
+                project_name=None,
+                category_costs=defaultdict(float, {"Unallocated": rolling_unallocated}),
+                daily_costs=unallocated_costs,
+                total_cost=total_unallocated,
+                rolling_30d_cost=rolling_unallocated,
+            )
+
+    # Write per-resource files and build the project/service indexes.
+    # Directories are created here; the small file writes are handed to a thread pool.
     projects_seen = set()
     services_seen = set()
+    proj_index = {}
+    svc_index = {}
+
+    # Plain string paths avoid building Path objects for every resource
+    by_resource_s = str(by_resource)
+    writes = []
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+        for safe_name, data in resources.items():
+            resource_dir = os.path.join(by_resource_s, safe_name)
+            os.makedirs(resource_dir, exist_ok=True)
+
+            cost_data = {
+                "provider": "gcp",
+                "resource_name": data.resource_name,
+                "resource_group": data.project_id,
+                "rolling_30d_cost": round(data.rolling_30d_cost, 2),
+                "total_cost": round(data.total_cost, 2),
+                "categories": sorted(data.category_costs),
+                "currency": currency,
+                "last_updated": today,
+                "data_range": {"start": data_start, "end": data_end},
+                "daily_costs": {date_names[date_id]: round(cost, 2) for date_id, cost in data.daily_costs},
+                "provider_metadata": {
+                    "project_id": data.project_id,
+                    "project_name": data.project_name,
+                },
+            }
 
-    for safe_name, data in resources.items():
-        resource_dir = by_resource / safe_name
-        resource_dir.mkdir(parents=True, exist_ok=True)
-
-        daily_sorted = sorted(data["daily_costs"].items(), key=lambda x: x[0], reverse=True)
-
-        cost_data = {
-            "provider": "gcp",
-            "resource_name": data["resource_name"],
-            "resource_group": data["project_id"],
-            "rolling_30d_cost": round(data["rolling_30d_cost"], 2),
-            "total_cost": round(data["total_cost"], 2),
-            "categories": sorted(data["categories"]),
-            "currency": currency,
-            "last_updated": today,
-            "data_range": {"start": data_start, "end": data_end},
-            "daily_costs": {date: round(cost, 2) for date, cost in daily_sorted},
-            "provider_metadata": {
-                "project_id": data["project_id"],
-                "project_name": data["project_name"],
-            },
-        }
-
-        with open(resource_dir / "cost.json", "w") as f:
-            json.dump(cost_data, f, indent=2)
-
-        # Project symlinks
-        project_id = sanitize_name(data["project_id"])
-        if project_id:
-            proj_dir = by_project / project_id
-            proj_dir.mkdir(parents=True, exist_ok=True)
-            link_path = proj_dir / safe_name
-            if not link_path.exists():
-                link_path.symlink_to(Path("../../by-resource") / safe_name)
-            projects_seen.add(data["project_id"])
-
-        # Service symlinks
-        for cat in data["categories"]:
-            safe_cat = sanitize_name(cat)
-            if safe_cat:
-                svc_dir = by_service / safe_cat
-                svc_dir.mkdir(parents=True, exist_ok=True)
-                link_path = svc_dir / safe_name
-                if not link_path.exists():
-                    link_path.symlink_to(Path("../../by-resource") / safe_name)
-                services_seen.add(cat)
+            payload = orjson.dumps(cost_data, option=orjson.OPT_INDENT_2)
+            writes.append(pool.submit(write_file, os.path.join(resource_dir, "cost.json"), payload))
 
-    # Generate summary
-    rolling_total = sum(r["rolling_30d_cost"] for r in resources.values())
-    total_all_time = sum(r["total_cost"] for r in resources.values())
+            # Project index
+            project_id = sanitize_name(data.project_id)
+            if project_id:
+                proj_index.setdefault(project_id, set()).add(safe_name)
+                projects_seen.add(data.project_id)
 
-    top_resources = sorted(resources.items(), key=lambda x: x[1]["rolling_30d_cost"], reverse=True)[:20]
+            # Service index
+            for cat in data.category_costs:
+                safe_cat = sanitize_name(cat)
+                if safe_cat:
+                    svc_index.setdefault(safe_cat, set()).add(safe_name)
+                    services_seen.add(cat)
 
-    daily_totals = {}
-    for data in resources.values():
-        for date, cost in data["daily_costs"].items():
-            if date not in daily_totals:
-                daily_totals[date] = 0
-            daily_totals[date] += cost
+    # Surface any write error
+    for write in writes:
+        write.result()
+
+    for index_dir, index in ((by_project, proj_index), (by_service, svc_index)):
+        index_data = {k: sorted(v) for k, v in sorted(index.items())}
+        (index_dir / "index.json").write_bytes(orjson.dumps(index_data, option=orjson.OPT_INDENT_2))
+
+    # Generate summary
+    rolling_total = sum(r.rolling_30d_cost for r in resources.values())
+    total_all_time = sum(r.total_cost for r in resources.values())
+
+    top_resources = heapq.nlargest(20, resources.items(), key=lambda x: x[1].rolling_30d_cost)
 
     daily_totals_sorted = {k: round(v, 2) for k, v in sorted(daily_totals.items(), reverse=True)}
 
     by_category_totals = {}
     for safe_name, data in resources.items():
-        for cat, cat_cost in data.get("category_costs", {}).items():
+        if safe_name == "_unallocated_":
+            continue
+        for cat, cat_cost in data.category_costs.items():
             if cat not in by_category_totals:
                 by_category_totals[cat] = 0
             by_category_totals[cat] += cat_cost
@@ -220,19 +286,32 @@ def generate_structure(rows, accurate_totals=None):
         "category_count": len(services_seen),
         "project_count": len(projects_seen),
         "top_20_resources": [
-            {"name": name, "rolling_30d_cost": round(data["rolling_30d_cost"], 2)}
+            {"name": name, "rolling_30d_cost": round(data.rolling_30d_cost, 2)}
             for name, data in top_resources
         ],
         "daily_totals": daily_totals_sorted,
         "by_category": by_category_totals,
     }
 
-    with open(COSTS_DIR / "summary.json", "w") as f:
-        json.dump(summary, f, indent=2)
+    (STAGING_DIR / "summary.json").write_bytes(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+
+    publish_structure()
 
     return summary
 
 
+def publish_structure():
+    """Replace COSTS_DIR with the completed staging tree."""
+    old_dir = COSTS_DIR.with_name(COSTS_DIR.name + ".old")
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
+    if COSTS_DIR.exists():
+        os.rename(COSTS_DIR, old_dir)
+    os.rename(STAGING_DIR, COSTS_DIR)
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
+
+
 def main():
     print("=" * 60)
     print("GCP Cost Structure Generator")
@@ -242,25 +321,17 @@ def main():
 
     validate_config()
 
-    print("[1] Fetching daily totals (accurate)...")
-    accurate_totals = fetch_daily_totals()
+    print("[1] Fetching daily cost data (detailed) and totals (accurate)...")
+    accurate_totals, rows = fetch_daily_costs_and_totals()
     print(f"    Got {len(accurate_totals)} days of totals")
 
-    print("[2] Fetching daily cost data (detailed)...")
-    rows = fetch_daily_costs()
-    print(f"    Fetched {len(rows)} cost entries")
+    print("[2] Generating directory structure...")
+    summary = generate_structure(rows, accurate_totals)
 
-    if not rows:
+    if summary is None:
         print("    No data fetched")
         return 1
 
-    dates = sorted(set(r["usage_date"] for r in rows if r.get("usage_date")))
-    if dates:
-        print(f"    Date range: {dates[0]} to {dates[-1]} ({len(dates)} days)")
-
-    print("[3] Generating directory structure...")
-    summary = generate_structure(rows, accurate_totals)
-
     print()
     print("=" * 60)
     print(f"Generated structure in {COSTS_DIR}/")